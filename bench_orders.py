@@ -0,0 +1,131 @@
+# bench_orders.py
+# Round-trips DB par commande confirmée : ancien flux (3 commits + refresh)
+# vs OrderService.place_order (une transaction, RETURNING, cache client).
+#
+#   python bench_orders.py [nb_commandes]
+#
+# Utilise une base SQLite temporaire (DATABASE_URL ignorée).
+
+import os
+import sys
+import json
+import tempfile
+import time
+from datetime import datetime
+
+_tmp = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+os.environ["DATABASE_URL"] = f"sqlite:///{_tmp.name}"
+os.environ.setdefault("LLM_PROVIDER", "")
+
+from sqlalchemy import event  # noqa: E402
+
+import main  # noqa: E402
+from main import (Conversation, Customer, Order, OrderService, OrderStatus,  # noqa: E402
+                  SessionLocal, engine)
+
+ITEMS = [{"name": "Pizza Margherita", "price": 12.0, "quantity": 2},
+         {"name": "Coca-Cola", "price": 3.0, "quantity": 1}]
+
+
+class Counter:
+    def __init__(self):
+        self.statements = 0
+        self.commits = 0
+
+    def reset(self):
+        self.statements = 0
+        self.commits = 0
+
+counter = Counter()
+
+@event.listens_for(engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context, executemany):
+    counter.statements += 1
+
+@event.listens_for(engine, "commit")
+def _count_commit(conn):
+    counter.commits += 1
+
+
+# --- ancien flux (copie du code avant passage en transaction unique)
+def legacy_confirm(db, phone, items, context):
+    c = db.query(Customer).filter(Customer.phone_number == phone).first()
+    if not c:
+        c = Customer(phone_number=phone)
+        db.add(c)
+        db.commit()
+        db.refresh(c)
+    order = Order(customer_id=c.id, total_amount=sum(i["price"] * i["quantity"] for i in items),
+                  items=json.dumps(items), notes="", status=OrderStatus.PENDING)
+    db.add(order)
+    db.commit()
+    db.refresh(order)
+    context["last_order_id"] = order.id
+    conv = db.query(Conversation).filter(Conversation.phone_number == phone).first()
+    if not conv:
+        conv = Conversation(phone_number=phone)
+        db.add(conv)
+    conv.context = json.dumps(context)
+    conv.last_interaction = datetime.utcnow()
+    db.commit()
+    return order.id
+
+def legacy_admin_phone(db, order):
+    customer = db.query(Customer).filter(Customer.id == order.customer_id).first()
+    return customer.phone_number if customer else None
+
+
+def new_confirm(db, phone, items, context):
+    return OrderService(db).place_order(phone, items, context)
+
+def new_admin_phone(db, order):
+    return OrderService(db).customer_phone(order.customer_id)
+
+
+def run(label, confirm, admin_phone, n, phones):
+    counter.reset()
+    stmts_confirm = 0
+    commits_confirm = 0
+    t0 = time.perf_counter()
+    for i in range(n):
+        phone = phones[i % len(phones)]
+        db = SessionLocal()
+        try:
+            before_s, before_c = counter.statements, counter.commits
+            order_id = confirm(db, phone, ITEMS, {"state": "order_pending_restaurant", "current_order": []})
+            stmts_confirm += counter.statements - before_s
+            commits_confirm += counter.commits - before_c
+            order = db.get(Order, order_id)
+            assert admin_phone(db, order) == phone
+        finally:
+            db.close()
+    elapsed = time.perf_counter() - t0
+    print(f"{label:<8} {stmts_confirm / n:>10.2f} {commits_confirm / n:>9.2f} "
+          f"{counter.statements / n:>12.2f} {elapsed / n * 1000:>9.3f}")
+
+
+def reset_tables():
+    db = SessionLocal()
+    try:
+        for model in (Order, Conversation, Customer):
+            db.query(model).delete()
+        db.commit()
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    # 1/4 de nouveaux clients, le reste des clients qui recommandent
+    phones = [f"3360000{i:04d}" for i in range(max(1, n // 4))]
+    print(f"{n} commandes, {len(phones)} clients (SQLite {engine.url.database})")
+    print(f"{'flux':<8} {'stmt/cmd':>10} {'commit/cmd':>9} {'stmt+admin':>12} {'ms/cmd':>9}")
+    try:
+        reset_tables()
+        run("legacy", legacy_confirm, legacy_admin_phone, n, phones)
+        reset_tables()
+        main.customer_cache.clear()
+        run("new", new_confirm, new_admin_phone, n, phones)
+    finally:
+        engine.dispose()
+        os.unlink(_tmp.name)
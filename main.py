@@ -7,19 +7,33 @@
 # - Flux restaurant (confirmation & statuts) + notifications client
 # - Modifications panier (ajouter / supprimer / vider)
 # - Fallback template pour ouvrir la fenêtre 24h côté restaurant
+# - Suivi des statuts de livraison WA (sent/delivered/read/failed) + latences
+# - Fallback LLM optionnel pour les messages non compris (cache + batching)
 
 import os
 import re
+import abc
 import json
 import logging
+import math
+import queue
+import difflib
+import hashlib
+import threading
+import time
 import unicodedata
-from datetime import datetime
-from typing import List, Dict, Optional
+from collections import OrderedDict
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional, Tuple
 
 from fastapi import FastAPI, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import JSONResponse
 
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Float, Text, ForeignKey
+from sqlalchemy import create_engine, event, func, insert, select, update, Column, Integer, String, DateTime, Float, Text, ForeignKey
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session, relationship
 
@@ -35,6 +49,21 @@ class Config:
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///./whatsapp_orders.db")
     # Numéro WhatsApp du restaurant (E.164 sans +, ex: 33758262447)
     RESTAURANT_PHONE: str = os.getenv("RESTAURANT_PHONE", "33758262447")
+    # Buffer des statuts WA : flush en bulk dès N lignes ou après X secondes
+    STATUS_BUFFER_SIZE: int = int(os.getenv("STATUS_BUFFER_SIZE", "200"))
+    STATUS_FLUSH_SECONDS: float = float(os.getenv("STATUS_FLUSH_SECONDS", "5"))
+    # Fallback LLM pour les messages non compris : "" (désactivé) | stub | anthropic | openai
+    LLM_PROVIDER: str = os.getenv("LLM_PROVIDER", "")
+    LLM_MODEL: str = os.getenv("LLM_MODEL", "")
+    LLM_TIMEOUT_SECONDS: float = float(os.getenv("LLM_TIMEOUT_SECONDS", "4"))
+    LLM_CACHE_SIZE: int = int(os.getenv("LLM_CACHE_SIZE", "1000"))
+    LLM_CACHE_TTL_SECONDS: float = float(os.getenv("LLM_CACHE_TTL_SECONDS", "3600"))
+    LLM_MAX_CONCURRENCY: int = int(os.getenv("LLM_MAX_CONCURRENCY", "2"))
+    LLM_BATCH_SIZE: int = int(os.getenv("LLM_BATCH_SIZE", "8"))
+    LLM_BATCH_WINDOW_MS: int = int(os.getenv("LLM_BATCH_WINDOW_MS", "50"))
+    LLM_MAX_QUEUE: int = int(os.getenv("LLM_MAX_QUEUE", "64"))
+    # Cache téléphone <-> customer_id (flux client + commandes admin)
+    CUSTOMER_CACHE_SIZE: int = int(os.getenv("CUSTOMER_CACHE_SIZE", "5000"))
 
 config = Config()
 
@@ -42,6 +71,15 @@ config = Config()
 # DB
 # -----------------------------------------------------------------------------
 engine = create_engine(config.DATABASE_URL)
+
+if engine.dialect.name == "sqlite":
+    # SQLite n'applique pas les FK par défaut : sans ça, un customer_id périmé
+    # (cache client) créerait une commande orpheline sans erreur
+    @event.listens_for(engine, "connect")
+    def _sqlite_foreign_keys(dbapi_conn, _record):
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA foreign_keys=ON")
+        cur.close()
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
@@ -91,6 +129,27 @@ class Conversation(Base):
     context = Column(Text)  # JSON
     last_interaction = Column(DateTime, default=datetime.utcnow)
 
+class OutboundMessage(Base):
+    """Message sortant (wamid renvoyé par Graph) rattaché à une commande / conversation."""
+    __tablename__ = "outbound_messages"
+    id = Column(Integer, primary_key=True, index=True)
+    wamid = Column(String, unique=True, index=True)
+    phone_number = Column(String, index=True)
+    kind = Column(String, index=True)  # ex: reply, menu, restaurant_order, client_confirmed
+    order_id = Column(Integer, ForeignKey("orders.id"), nullable=True, index=True)
+    sent_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+class MessageStatus(Base):
+    """Callback de statut WA (sent/delivered/read/failed) pour un wamid."""
+    __tablename__ = "message_statuses"
+    id = Column(Integer, primary_key=True, index=True)
+    wamid = Column(String, index=True)
+    status = Column(String)
+    timestamp = Column(DateTime)  # horodatage WA (UTC)
+    recipient = Column(String)
+    error = Column(Text)
+    received_at = Column(DateTime, default=datetime.utcnow)
+
 Base.metadata.create_all(bind=engine)
 
 def get_db():
@@ -100,6 +159,13 @@ def get_db():
     finally:
         db.close()
 
+def save_conversation_context(db: Session, phone: str, context: Dict):
+    """UPDATE (ou INSERT si absente) de la conversation, sans commit ni SELECT préalable."""
+    values = {"context": json.dumps(context), "last_interaction": datetime.utcnow()}
+    res = db.execute(update(Conversation).where(Conversation.phone_number == phone).values(**values))
+    if res.rowcount == 0:
+        db.execute(insert(Conversation).values(phone_number=phone, **values))
+
 # -----------------------------------------------------------------------------
 # Utils / normalisation texte
 # -----------------------------------------------------------------------------
@@ -115,6 +181,199 @@ def normalize(s: str) -> str:
 def format_lines(items: List[Dict]) -> List[str]:
     return [f"• {i['quantity']}× {i['name']} — €{i['price'] * i['quantity']:.2f}" for i in items]
 
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Percentile par rang le plus proche (values non triées acceptées)."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, math.ceil(pct / 100.0 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+# -----------------------------------------------------------------------------
+# Delivery tracking (statuts WA)
+# -----------------------------------------------------------------------------
+class DeliveryTracker:
+    """
+    Bufferise en mémoire les wamid sortants et les callbacks de statut,
+    puis les écrit en bulk insert (les statuts sont plusieurs fois plus
+    nombreux que les messages : pas de commit par callback).
+    Flush dès max_size lignes, et toutes les flush_seconds via un thread
+    de fond (start/stop) pour ne rien garder en mémoire quand le trafic est calme.
+    """
+
+    def __init__(self, max_size: int = 200, flush_seconds: float = 5.0, max_pending: Optional[int] = None):
+        self.max_size = max_size
+        self.flush_seconds = flush_seconds
+        # plafond du buffer quand la DB refuse les écritures (lignes remises en file)
+        self.max_pending = max_pending or max_size * 20
+        self._outbound: List[Dict] = []
+        self._statuses: List[Dict] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._timer: Optional[threading.Thread] = None
+
+    def record_outbound(self, wamid: str, phone: str, kind: str, order_id: Optional[int] = None):
+        if not wamid:
+            return
+        with self._lock:
+            self._outbound.append({
+                "wamid": wamid,
+                "phone_number": phone,
+                "kind": kind,
+                "order_id": order_id,
+                "sent_at": datetime.utcnow(),
+            })
+        self.maybe_flush()
+
+    def record_statuses(self, statuses: List[Dict]):
+        rows = []
+        for st in statuses:
+            wamid = st.get("id")
+            if not wamid:
+                continue
+            try:
+                ts = datetime.utcfromtimestamp(int(st.get("timestamp")))
+            except (TypeError, ValueError, OverflowError, OSError):
+                # pas d'horodatage WA fiable : exclu des latences plutôt que faussé
+                ts = None
+            errors = st.get("errors") or []
+            rows.append({
+                "wamid": wamid,
+                "status": st.get("status"),
+                "timestamp": ts,
+                "recipient": st.get("recipient_id"),
+                "error": json.dumps(errors) if errors else None,
+                "received_at": datetime.utcnow(),
+            })
+        if not rows:
+            return
+        with self._lock:
+            self._statuses.extend(rows)
+        self.maybe_flush()
+
+    def pending(self) -> int:
+        with self._lock:
+            return len(self._outbound) + len(self._statuses)
+
+    def maybe_flush(self):
+        if self.pending() >= self.max_size:
+            self.flush()
+
+    # ---- flush périodique
+    def start(self):
+        if self._timer is not None and self._timer.is_alive():
+            return
+        self._stop.clear()
+        self._timer = threading.Thread(target=self._run_timer, name="delivery-flush", daemon=True)
+        self._timer.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._timer is not None:
+            self._timer.join(timeout=self.flush_seconds + 1)
+            self._timer = None
+        self.flush()
+
+    def _run_timer(self):
+        while not self._stop.wait(self.flush_seconds):
+            self.flush()
+
+    def flush(self) -> int:
+        """
+        Écrit le buffer : une transaction par table, wamid sortants dédupliqués
+        (ON CONFLICT DO NOTHING). En cas d'erreur, les lignes sont remises en
+        file (dans la limite de max_pending). Retourne le nb de lignes écrites.
+        """
+        with self._flush_lock:
+            with self._lock:
+                outbound, self._outbound = self._outbound, []
+                statuses, self._statuses = self._statuses, []
+            written = 0
+            if outbound:
+                if self._write(self._outbound_insert(), outbound, "sortants"):
+                    written += len(outbound)
+                else:
+                    self._requeue(self._outbound, outbound, "sortants")
+            if statuses:
+                if self._write(insert(MessageStatus), statuses, "statuts"):
+                    written += len(statuses)
+                else:
+                    self._requeue(self._statuses, statuses, "statuts")
+            return written
+
+    def _outbound_insert(self):
+        dialect = engine.dialect.name
+        if dialect == "sqlite":
+            return sqlite.insert(OutboundMessage).on_conflict_do_nothing(index_elements=["wamid"])
+        if dialect == "postgresql":
+            return postgresql.insert(OutboundMessage).on_conflict_do_nothing(index_elements=["wamid"])
+        return insert(OutboundMessage)
+
+    def _write(self, stmt, rows: List[Dict], label: str) -> bool:
+        db = SessionLocal()
+        try:
+            db.execute(stmt, rows)
+            db.commit()
+            return True
+        except Exception as e:
+            db.rollback()
+            logging.error(f"Delivery flush failed ({len(rows)} {label}): {e}")
+            return False
+        finally:
+            db.close()
+
+    def _requeue(self, buffer: List[Dict], rows: List[Dict], label: str):
+        with self._lock:
+            buffer[:0] = rows
+            overflow = len(buffer) - self.max_pending
+            if overflow > 0:
+                del buffer[:overflow]
+                logging.error(f"Delivery buffer plein : {overflow} {label} les plus anciens abandonnés")
+
+    def latency_report(self, db: Session, hours: float = 24.0) -> Dict[str, Dict]:
+        """
+        Latences (secondes) envoi -> delivered / read par type de message,
+        avec p50/p90/p99 et nb de messages en échec, sur les `hours` dernières heures.
+        """
+        since = datetime.utcnow() - timedelta(hours=hours)
+        # premier callback par (wamid, statut) : WA peut renvoyer un même statut
+        rows = (db.query(OutboundMessage.kind, OutboundMessage.sent_at,
+                         MessageStatus.status, func.min(MessageStatus.timestamp))
+                .join(MessageStatus, MessageStatus.wamid == OutboundMessage.wamid)
+                .filter(OutboundMessage.sent_at >= since,
+                        MessageStatus.status.in_(("delivered", "read", "failed")))
+                .group_by(OutboundMessage.wamid, OutboundMessage.kind, OutboundMessage.sent_at,
+                          MessageStatus.status)
+                .all())
+
+        samples: Dict[str, Dict[str, List[float]]] = {}
+        failed: Dict[str, int] = {}
+        for kind, sent_at, status, ts in rows:
+            if status == "failed":
+                failed[kind] = failed.get(kind, 0) + 1
+                continue
+            if sent_at is None or ts is None:
+                continue
+            delta = max(0.0, (ts - sent_at).total_seconds())
+            samples.setdefault(kind, {"delivered": [], "read": []})[status].append(delta)
+
+        report: Dict[str, Dict] = {}
+        for kind in sorted(set(samples) | set(failed)):
+            per_status = samples.get(kind, {"delivered": [], "read": []})
+            out: Dict = {"failed": failed.get(kind, 0)}
+            for status, vals in per_status.items():
+                out[status] = {
+                    "count": len(vals),
+                    "p50": percentile(vals, 50),
+                    "p90": percentile(vals, 90),
+                    "p99": percentile(vals, 99),
+                }
+            report[kind] = out
+        return report
+
+delivery_tracker = DeliveryTracker(config.STATUS_BUFFER_SIZE, config.STATUS_FLUSH_SECONDS)
+
 # -----------------------------------------------------------------------------
 # WhatsApp Service (v22)
 # -----------------------------------------------------------------------------
@@ -130,34 +389,43 @@ class WhatsAppService:
             "Content-Type": "application/json",
         }
 
-    def send_message(self, to: str, message: str) -> bool:
+    def _post(self, data: Dict, label: str, kind: str, order_id: Optional[int]) -> bool:
+        """POST /messages ; enregistre le wamid renvoyé par Graph pour le suivi des statuts."""
         url = f"{self.base_url}/messages"
-        data = {
-            "messaging_product": "whatsapp",
-            "to": to,
-            "type": "text",
-            "text": {"body": message},
-        }
         try:
             r = requests.post(url, json=data, headers=self._headers(), timeout=15)
             ok = r.status_code in (200, 201)
             if ok:
-                logging.info(f"WA text ok: {r.text}")
+                logging.info(f"WA {label} ok: {r.text}")
+                try:
+                    wamid = (r.json().get("messages") or [{}])[0].get("id")
+                except Exception:
+                    wamid = None
+                delivery_tracker.record_outbound(wamid, data.get("to"), kind, order_id)
             else:
-                logging.error(f"WA text failed {r.status_code}: {r.text}")
+                logging.error(f"WA {label} failed {r.status_code}: {r.text}")
             return ok
         except Exception as e:
-            logging.error(f"WA text error: {e}")
+            logging.error(f"WA {label} error: {e}")
             return False
 
-    def send_template(self, to: str, name: str, lang: str = "en_US", variables: Optional[List[str]] = None) -> bool:
+    def send_message(self, to: str, message: str, kind: str = "reply", order_id: Optional[int] = None) -> bool:
+        data = {
+            "messaging_product": "whatsapp",
+            "to": to,
+            "type": "text",
+            "text": {"body": message},
+        }
+        return self._post(data, "text", kind, order_id)
+
+    def send_template(self, to: str, name: str, lang: str = "en_US", variables: Optional[List[str]] = None,
+                      kind: str = "template", order_id: Optional[int] = None) -> bool:
         """
         Envoie un template pour ouvrir la fenêtre 24h si nécessaire.
         - name: nom du template approuvé (ex: "hello_world")
         - lang: code langue WA (ex: "en_US", "fr_FR")
         - variables: liste de textes à injecter dans le body du template
         """
-        url = f"{self.base_url}/messages"
         components = []
         if variables:
             components = [{
@@ -174,19 +442,9 @@ class WhatsAppService:
                 "components": components
             }
         }
-        try:
-            r = requests.post(url, json=data, headers=self._headers(), timeout=15)
-            ok = r.status_code in (200, 201)
-            if ok:
-                logging.info(f"WA template ok: {r.text}")
-            else:
-                logging.error(f"WA template failed {r.status_code}: {r.text}")
-            return ok
-        except Exception as e:
-            logging.error(f"WA template error: {e}")
-            return False
+        return self._post(data, "template", kind, order_id)
 
-    def send_interactive_menu(self, to: str, products: List[Dict]) -> bool:
+    def send_interactive_menu(self, to: str, products: List[Dict], kind: str = "menu") -> bool:
         rows = []
         for p in products[:10]:
             title = p.get("name", "Article")
@@ -202,7 +460,6 @@ class WhatsAppService:
         if not rows:
             return False
 
-        url = f"{self.base_url}/messages"
         data = {
             "messaging_product": "whatsapp",
             "to": to,
@@ -221,48 +478,509 @@ class WhatsAppService:
                 }
             }
         }
+        return self._post(data, "interactive", kind, None)
+
+# -----------------------------------------------------------------------------
+# LLM fallback (messages non compris)
+# -----------------------------------------------------------------------------
+# ni "confirm" ni "clear" : le fallback ne doit jamais valider ni vider le panier
+# à la place du client (seuls les mots-clés confirmer / vider le font)
+LLM_INTENTS = ("greeting", "menu", "order", "remove", "other")
+
+NEGATIONS = ("pas", "sans", "non", "jamais", "aucun", "aucune")
+
+NUMBER_WORDS = {"un": 1, "une": 1, "deux": 2, "trois": 3, "quatre": 4, "cinq": 5,
+                "six": 6, "sept": 7, "huit": 8, "neuf": 9, "dix": 10}
+
+def cache_key(text: str) -> str:
+    """Clé de cache : texte normalisé, sans ponctuation, espaces compactés."""
+    t = re.sub(r"[^\w\s]", " ", normalize(text))
+    return re.sub(r"\s+", " ", t).strip()
+
+def catalog_fingerprint(catalog: List[str]) -> str:
+    """Empreinte du catalogue : un changement de carte invalide les entrées de cache."""
+    return hashlib.sha1("\n".join(sorted(catalog)).encode("utf-8")).hexdigest()[:12]
+
+def sanitize_llm_result(result: Optional[Dict], catalog: List[str]) -> Dict:
+    """Contraint la sortie LLM : intent connue, articles du catalogue, quantités 1..20."""
+    if not isinstance(result, dict):
+        return {"intent": "other", "items": []}
+    intent = result.get("intent")
+    if intent not in LLM_INTENTS:
+        intent = "other"
+    by_norm = {normalize(name): name for name in catalog}
+    items: List[Dict] = []
+    for it in result.get("items") or []:
+        if not isinstance(it, dict):
+            continue
+        name = by_norm.get(normalize(str(it.get("name", ""))))
+        if not name:
+            continue
         try:
-            r = requests.post(url, json=data, headers=self._headers(), timeout=15)
-            ok = r.status_code in (200, 201)
-            if ok:
-                logging.info(f"WA interactive ok: {r.text}")
+            qty = int(it.get("quantity", 1))
+        except (TypeError, ValueError):
+            qty = 1
+        items.append({"name": name, "quantity": min(20, max(1, qty))})
+    return {"intent": intent, "items": items}
+
+
+class LLMProvider(abc.ABC):
+    """Interface : interprète un lot de messages en une seule requête."""
+    name = "base"
+
+    def __init__(self, model: str = "", timeout: float = 4.0):
+        self.model = model
+        self.timeout = timeout
+
+    @abc.abstractmethod
+    def interpret_batch(self, texts: List[str], catalog: List[str]) -> List[Dict]:
+        ...
+
+    def _prompt(self, catalog: List[str]) -> str:
+        return (
+            "Tu interprètes des messages WhatsApp de clients d'un restaurant.\n"
+            f"Catalogue (noms exacts) : {json.dumps(catalog, ensure_ascii=False)}\n"
+            f"Intentions possibles : {', '.join(LLM_INTENTS)}.\n"
+            "On te donne un tableau JSON de messages. Réponds UNIQUEMENT par un objet JSON "
+            '{"results": [{"intent": "...", "items": [{"name": "...", "quantity": 1}]}]} '
+            "avec un résultat par message, dans le même ordre. N'utilise que des noms du catalogue."
+        )
+
+    def _parse(self, raw: str, expected: int) -> List[Dict]:
+        m = re.search(r"\{.*\}", raw or "", re.S)
+        data = json.loads(m.group(0)) if m else {}
+        results = data.get("results") or []
+        if len(results) != expected:
+            raise ValueError(f"LLM: {len(results)} résultats pour {expected} messages")
+        return results
+
+
+class StubLLMProvider(LLMProvider):
+    """Provider local déterministe (tests / dev) : fuzzy-match sur le catalogue, sans réseau."""
+    name = "stub"
+
+    def interpret_batch(self, texts: List[str], catalog: List[str]) -> List[Dict]:
+        return [self._interpret(t, catalog) for t in texts]
+
+    def _interpret(self, text: str, catalog: List[str]) -> Dict:
+        words = cache_key(text).split()
+        if any(w in words for w in ("carte", "plats", "choix")):
+            return {"intent": "menu", "items": []}
+        items = self._items(words, catalog)
+        return {"intent": "order" if items else "other", "items": items}
+
+    def _items(self, words: List[str], catalog: List[str]) -> List[Dict]:
+        # mot-clé distinctif par produit (dernier mot significatif du nom)
+        keys: Dict[str, str] = {}
+        for name in catalog:
+            sig = [w for w in cache_key(name).split() if len(w) >= 4 and not w.isdigit()]
+            if sig:
+                keys[sig[-1]] = name
+        items: List[Dict] = []
+        for i, w in enumerate(words):
+            match = difflib.get_close_matches(w.rstrip("s"), list(keys), n=1, cutoff=0.75)
+            if not match:
+                continue
+            # "non pas de coca", "sans coca" : article refusé, pas commandé
+            if any(prev in NEGATIONS for prev in words[max(0, i - 3):i]):
+                continue
+            qty = 1
+            for prev in reversed(words[max(0, i - 3):i]):
+                if prev.isdigit():
+                    qty = int(prev)
+                    break
+                if prev in NUMBER_WORDS:
+                    qty = NUMBER_WORDS[prev]
+                    break
+            items.append({"name": keys[match[0]], "quantity": qty})
+        return items
+
+
+class AnthropicLLMProvider(LLMProvider):
+    name = "anthropic"
+
+    def __init__(self, model: str = "", timeout: float = 4.0):
+        super().__init__(model or "claude-3-5-haiku-latest", timeout)
+        import anthropic  # dépendance optionnelle
+        self.client = anthropic.Anthropic(timeout=timeout, max_retries=0)
+
+    def interpret_batch(self, texts: List[str], catalog: List[str]) -> List[Dict]:
+        resp = self.client.messages.create(
+            model=self.model,
+            max_tokens=200 + 120 * len(texts),
+            system=self._prompt(catalog),
+            messages=[{"role": "user", "content": json.dumps(texts, ensure_ascii=False)}],
+        )
+        raw = "".join(getattr(b, "text", "") for b in resp.content)
+        return self._parse(raw, len(texts))
+
+
+class OpenAILLMProvider(LLMProvider):
+    name = "openai"
+
+    def __init__(self, model: str = "", timeout: float = 4.0):
+        super().__init__(model or "gpt-4o-mini", timeout)
+        import openai  # dépendance optionnelle
+        self.client = openai.OpenAI(timeout=timeout, max_retries=0)
+
+    def interpret_batch(self, texts: List[str], catalog: List[str]) -> List[Dict]:
+        resp = self.client.chat.completions.create(
+            model=self.model,
+            response_format={"type": "json_object"},
+            messages=[
+                {"role": "system", "content": self._prompt(catalog)},
+                {"role": "user", "content": json.dumps(texts, ensure_ascii=False)},
+            ],
+        )
+        return self._parse(resp.choices[0].message.content, len(texts))
+
+
+LLM_PROVIDERS = {
+    "stub": StubLLMProvider,
+    "anthropic": AnthropicLLMProvider,
+    "openai": OpenAILLMProvider,
+}
+
+
+class TTLCache:
+    """Cache LRU borné avec expiration (thread-safe)."""
+
+    def __init__(self, max_size: int = 1000, ttl: float = 3600.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data: "OrderedDict[str, Tuple[float, Dict]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            hit = self._data.get(key)
+            if hit is None:
+                return None
+            expires, value = hit
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value: Dict):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class _PendingRequest:
+    """Requête LLM en file : abandonnée si plus personne ne l'attend (deadline dépassée)."""
+    __slots__ = ("key", "text", "catalog", "future", "deadline")
+
+    def __init__(self, key: str, text: str, catalog: List[str], deadline: float):
+        self.key = key
+        self.text = text
+        self.catalog = catalog
+        self.future: Future = Future()
+        self.deadline = deadline
+
+
+class LLMInterpreter:
+    """
+    Interprète les messages "other" via un LLMProvider :
+    - cache par texte normalisé + empreinte du catalogue (TTL + éviction LRU)
+    - déduplication des requêtes identiques en vol
+    - micro-batching (LLM_BATCH_SIZE messages / LLM_BATCH_WINDOW_MS)
+    - au plus LLM_MAX_CONCURRENCY appels provider simultanés, file bornée (LLM_MAX_QUEUE)
+    - timeout strict : None => l'appelant garde la réponse par règles ; les requêtes
+      dont l'appelant a abandonné ne sont jamais envoyées au provider
+    """
+
+    def __init__(self, provider: LLMProvider, timeout: float = 4.0, cache_size: int = 1000,
+                 cache_ttl: float = 3600.0, max_concurrency: int = 2, batch_size: int = 8,
+                 batch_window: float = 0.05, max_queue: int = 64):
+        self.provider = provider
+        self.timeout = timeout
+        self.cache = TTLCache(cache_size, cache_ttl)
+        self.batch_size = max(1, batch_size)
+        self.batch_window = batch_window
+        self._slots = threading.BoundedSemaphore(max(1, max_concurrency))
+        self._queue: "queue.Queue[_PendingRequest]" = queue.Queue(maxsize=max(1, max_queue))
+        self._inflight: Dict[str, _PendingRequest] = {}
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+
+    def interpret(self, text: str, catalog: List[str]) -> Optional[Dict]:
+        text_key = cache_key(text)
+        if not text_key:
+            return None
+        key = f"{catalog_fingerprint(catalog)}:{text_key}"
+        cached = self.cache.get(key)
+        if cached is not None:
+            return sanitize_llm_result(cached, catalog)
+
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            req = self._inflight.get(key)
+            if req is not None:
+                # un nouvel appelant attend : la requête reste utile jusqu'à sa deadline
+                req.deadline = max(req.deadline, deadline)
             else:
-                logging.error(f"WA interactive failed {r.status_code}: {r.text}")
-            return ok
+                req = _PendingRequest(key, text, catalog, deadline)
+                try:
+                    self._queue.put_nowait(req)
+                except queue.Full:
+                    logging.warning(f"LLM file pleine, fallback règles pour {text!r}")
+                    return None
+                self._inflight[key] = req
+                self._ensure_worker()
+        try:
+            result = req.future.result(timeout=self.timeout)
+        except FutureTimeout:
+            logging.warning(f"LLM timeout ({self.timeout}s) pour {text!r}")
+            return None
         except Exception as e:
-            logging.error(f"WA interactive error: {e}")
-            return False
+            logging.error(f"LLM error pour {text!r}: {e}")
+            return None
+        return sanitize_llm_result(result, catalog)
+
+    def _ensure_worker(self):
+        if self._worker is None or not self._worker.is_alive():
+            self._worker = threading.Thread(target=self._collect, name="llm-batcher", daemon=True)
+            self._worker.start()
+
+    def _drop_expired(self, batch: List[_PendingRequest]) -> List[_PendingRequest]:
+        now = time.monotonic()
+        alive = []
+        with self._lock:
+            for req in batch:
+                if req.deadline > now:
+                    alive.append(req)
+                    continue
+                self._inflight.pop(req.key, None)
+                if not req.future.done():
+                    req.future.set_exception(FutureTimeout())
+        return alive
+
+    def _collect(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            batch = self._drop_expired(batch)
+            if not batch:
+                continue
+            # bloque tant que LLM_MAX_CONCURRENCY appels sont déjà en cours
+            self._slots.acquire()
+            batch = self._drop_expired(batch)
+            if not batch:
+                self._slots.release()
+                continue
+            threading.Thread(target=self._run_batch, args=(batch,), daemon=True).start()
+
+    def _run_batch(self, batch: List[_PendingRequest]):
+        try:
+            texts = [req.text for req in batch]
+            catalog = batch[-1].catalog
+            try:
+                results = self.provider.interpret_batch(texts, catalog)
+            except Exception as e:
+                for req in batch:
+                    req.future.set_exception(e)
+                return
+            for req, result in zip(batch, results):
+                self.cache.set(req.key, result)
+                req.future.set_result(result)
+        finally:
+            with self._lock:
+                for req in batch:
+                    if self._inflight.get(req.key) is req:
+                        del self._inflight[req.key]
+            self._slots.release()
+
+
+def build_llm_interpreter() -> Optional[LLMInterpreter]:
+    name = (config.LLM_PROVIDER or "").strip().lower()
+    if not name:
+        return None
+    provider_cls = LLM_PROVIDERS.get(name)
+    if provider_cls is None:
+        logging.error(f"LLM_PROVIDER inconnu: {name!r} (attendu: {', '.join(LLM_PROVIDERS)})")
+        return None
+    try:
+        provider = provider_cls(config.LLM_MODEL, config.LLM_TIMEOUT_SECONDS)
+    except Exception as e:
+        logging.error(f"LLM provider {name} indisponible: {e}")
+        return None
+    return LLMInterpreter(
+        provider,
+        timeout=config.LLM_TIMEOUT_SECONDS,
+        cache_size=config.LLM_CACHE_SIZE,
+        cache_ttl=config.LLM_CACHE_TTL_SECONDS,
+        max_concurrency=config.LLM_MAX_CONCURRENCY,
+        batch_size=config.LLM_BATCH_SIZE,
+        batch_window=config.LLM_BATCH_WINDOW_MS / 1000.0,
+        max_queue=config.LLM_MAX_QUEUE,
+    )
+
+llm_interpreter = build_llm_interpreter()
 
 # -----------------------------------------------------------------------------
 # Order Service
 # -----------------------------------------------------------------------------
+class CustomerCache:
+    """
+    Cache LRU borné téléphone <-> customer_id (thread-safe).
+    Les clients ne sont jamais supprimés par l'app ; tout script qui en supprime
+    doit appeler customer_cache.discard(phone) / clear() (les FK ne détectent pas
+    un id réattribué à un autre client).
+    """
+
+    def __init__(self, max_size: int = 5000):
+        self.max_size = max_size
+        self._ids: "OrderedDict[str, int]" = OrderedDict()
+        self._phones: Dict[int, str] = {}
+        self._lock = threading.Lock()
+
+    def get_id(self, phone: str) -> Optional[int]:
+        with self._lock:
+            cid = self._ids.get(phone)
+            if cid is not None:
+                self._ids.move_to_end(phone)
+            return cid
+
+    def get_phone(self, customer_id: int) -> Optional[str]:
+        with self._lock:
+            phone = self._phones.get(customer_id)
+            if phone is not None:
+                self._ids.move_to_end(phone)
+            return phone
+
+    def put(self, phone: str, customer_id: int):
+        with self._lock:
+            # garde les deux index cohérents si le numéro ou l'id change de correspondance
+            prev_id = self._ids.get(phone)
+            if prev_id is not None and prev_id != customer_id:
+                self._phones.pop(prev_id, None)
+            prev_phone = self._phones.get(customer_id)
+            if prev_phone is not None and prev_phone != phone:
+                self._ids.pop(prev_phone, None)
+            self._ids[phone] = customer_id
+            self._ids.move_to_end(phone)
+            self._phones[customer_id] = phone
+            while len(self._ids) > self.max_size:
+                _phone, old_id = self._ids.popitem(last=False)
+                self._phones.pop(old_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._ids.clear()
+            self._phones.clear()
+
+    def discard(self, phone: str):
+        with self._lock:
+            cid = self._ids.pop(phone, None)
+            if cid is not None:
+                self._phones.pop(cid, None)
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+customer_cache = CustomerCache(config.CUSTOMER_CACHE_SIZE)
+
+
 class OrderService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, cache: Optional[CustomerCache] = None):
         self.db = db
+        self.cache = cache if cache is not None else customer_cache
+
+    def _supports_returning(self) -> bool:
+        return bool(getattr(self.db.get_bind().dialect, "insert_returning", False))
 
-    def get_or_create_customer(self, phone_number: str) -> Customer:
-        c = self.db.query(Customer).filter(Customer.phone_number == phone_number).first()
-        if not c:
-            c = Customer(phone_number=phone_number)
-            self.db.add(c)
+    def upsert_customer(self, phone_number: str) -> int:
+        """
+        customer_id du numéro (créé si besoin), sans commit. Cache d'abord, puis un seul
+        statement. Le cache n'est pas alimenté ici : l'id n'est sûr qu'après le commit.
+        """
+        cid = self.cache.get_id(phone_number)
+        if cid is not None:
+            return cid
+        dialect = self.db.get_bind().dialect.name
+        if dialect in ("sqlite", "postgresql") and self._supports_returning():
+            ins = (sqlite.insert if dialect == "sqlite" else postgresql.insert)(Customer)
+            stmt = (ins.values(phone_number=phone_number, created_at=datetime.utcnow())
+                    .on_conflict_do_update(index_elements=[Customer.phone_number],
+                                           set_={"phone_number": ins.excluded.phone_number})
+                    .returning(Customer.id))
+            cid = self.db.execute(stmt).scalar_one()
+        else:
+            cid = self.db.execute(
+                select(Customer.id).where(Customer.phone_number == phone_number)).scalar()
+            if cid is None:
+                res = self.db.execute(insert(Customer).values(phone_number=phone_number))
+                cid = res.inserted_primary_key[0]
+        return cid
+
+    def customer_phone(self, customer_id: Optional[int]) -> Optional[str]:
+        if customer_id is None:
+            return None
+        phone = self.cache.get_phone(customer_id)
+        if phone is None:
+            phone = self.db.execute(
+                select(Customer.phone_number).where(Customer.id == customer_id)).scalar()
+            if phone:
+                self.cache.put(phone, customer_id)
+        return phone
+
+    def place_order(self, phone_number: str, items: List[Dict], context: Dict, notes: str = "") -> int:
+        """
+        Commande en une transaction : upsert client + INSERT ... RETURNING id
+        + sauvegarde du contexte (last_order_id), un seul commit. Retourne l'id.
+        Si l'id client venait du cache et viole la FK (client supprimé), on
+        l'invalide et on rejoue une fois avec un upsert réel.
+        """
+        from_cache = self.cache.get_id(phone_number) is not None
+        try:
+            return self._place_order(phone_number, items, context, notes)
+        except IntegrityError:
+            if not from_cache:
+                raise
+            logging.warning(f"customer_id en cache périmé pour {phone_number}, nouvel essai")
+            return self._place_order(phone_number, items, context, notes)
+
+    def _place_order(self, phone_number: str, items: List[Dict], context: Dict, notes: str) -> int:
+        try:
+            customer_id = self.upsert_customer(phone_number)
+            total = sum(item["price"] * item["quantity"] for item in items)
+            stmt = insert(Order).values(
+                customer_id=customer_id,
+                total_amount=total,
+                items=json.dumps(items),
+                notes=notes,
+                status=OrderStatus.PENDING,
+            )
+            if self._supports_returning():
+                order_id = self.db.execute(stmt.returning(Order.id)).scalar_one()
+            else:
+                order_id = self.db.execute(stmt).inserted_primary_key[0]
+            context["last_order_id"] = order_id
+            save_conversation_context(self.db, phone_number, context)
             self.db.commit()
-            self.db.refresh(c)
-        return c
-
-    def create_order(self, phone_number: str, items: List[Dict], notes: str = "") -> Order:
-        customer = self.get_or_create_customer(phone_number)
-        total = sum(item["price"] * item["quantity"] for item in items)
-        order = Order(
-            customer_id=customer.id,
-            total_amount=total,
-            items=json.dumps(items),
-            notes=notes,
-            status=OrderStatus.PENDING,
-        )
-        self.db.add(order)
-        self.db.commit()
-        self.db.refresh(order)
-        return order
+        except Exception:
+            self.db.rollback()
+            # id en cache éventuellement périmé (client supprimé => FK) : relu au prochain essai
+            self.cache.discard(phone_number)
+            raise
+        self.cache.put(phone_number, customer_id)
+        return order_id
 
     def get_order(self, order_id: int) -> Optional[Order]:
         return self.db.query(Order).filter(Order.id == order_id).first()
@@ -277,16 +995,19 @@ class OrderService:
         except Exception:
             pass
         self.db.commit()
-        self.db.refresh(order)
 
 # -----------------------------------------------------------------------------
 # Conversation & Parsing
 # -----------------------------------------------------------------------------
 class ConversationService:
-    def __init__(self, db: Session):
+    def __init__(self, db: Session, llm: Optional[LLMInterpreter] = None):
         self.db = db
         self.whatsapp = WhatsAppService()
         self.order_service = OrderService(db)
+        self.llm = llm if llm is not None else llm_interpreter
+        # type/commande de la dernière réponse, pour le suivi des statuts WA
+        self.reply_kind = "reply"
+        self.reply_order_id: Optional[int] = None
 
     # ---- context
     def get_conversation_context(self, phone: str) -> Dict:
@@ -296,12 +1017,7 @@ class ConversationService:
         return {"state": "new", "current_order": []}
 
     def update_conversation_context(self, phone: str, context: Dict):
-        conv = self.db.query(Conversation).filter(Conversation.phone_number == phone).first()
-        if not conv:
-            conv = Conversation(phone_number=phone)
-            self.db.add(conv)
-        conv.context = json.dumps(context)
-        conv.last_interaction = datetime.utcnow()
+        save_conversation_context(self.db, phone, context)
         self.db.commit()
 
     # ---- produits
@@ -355,6 +1071,25 @@ class ConversationService:
             return "order"
         return "other"
 
+    # ---- fallback LLM
+    def _llm_fallback(self, msg: str) -> Tuple[str, Optional[List[Dict]]]:
+        """Interprète un message "other" via le LLM ; ("other", None) si indisponible/timeout."""
+        if self.llm is None:
+            return "other", None
+        prices = {p.name: float(p.price) for p in self._all_available_products()}
+        # rend la connexion au pool pendant l'attente LLM (pas d'idle-in-transaction)
+        self.db.rollback()
+        result = self.llm.interpret(msg, list(prices))
+        if not result:
+            return "other", None
+        items = [{"name": it["name"], "price": prices[it["name"]], "quantity": it["quantity"]}
+                 for it in result["items"] if it["name"] in prices]
+        intent = result["intent"]
+        if intent in ("order", "remove") and not items:
+            intent = "other"
+        logging.info(f"[llm] {msg!r} -> intent={intent} items={items}")
+        return intent, items
+
     # ---- parsing
     def _split_phrases(self, m: str) -> List[str]:
         m = re.sub(r"\s*(,|;|\+|\bet\b)\s*", "|", m)
@@ -429,7 +1164,11 @@ class ConversationService:
     def process_incoming_message(self, phone: str, message: str) -> str:
         context = self.get_conversation_context(phone)
         intent = self._detect_intent(message)
+        llm_items: Optional[List[Dict]] = None
+        if intent == "other":
+            intent, llm_items = self._llm_fallback(message)
         logging.info(f"[intent={intent}] from={phone} msg={message!r} ctx={context}")
+        context_saved = False
 
         if intent == "greeting":
             response = ("🍕 Bonjour! Bienvenue chez Barita Resto.\n"
@@ -447,12 +1186,12 @@ class ConversationService:
                 for p in products[:10]:
                     lines.append(f"• {p.name} — €{p.price:.2f}")
                 lines.append("\nRépondez par ex. : 2 margherita, 1 coca")
-                self.whatsapp.send_message(phone, "\n".join(lines))
+                self.whatsapp.send_message(phone, "\n".join(lines), kind="menu")
             response = "📋 Menu envoyé ! Vous pouvez aussi me dire directement ce que vous voulez."
             context["state"] = "menu_shown"
 
         elif intent in ("order", "add"):
-            items = self._parse_items(normalize(message))
+            items = llm_items if llm_items is not None else self._parse_items(normalize(message))
             if items:
                 self._add_items_to_context(context, items)
                 response = self._cart_response(context, "✅ Ajouté à votre commande !",
@@ -463,7 +1202,7 @@ class ConversationService:
                             "*2 margherita et 1 coca*.")
 
         elif intent == "remove":
-            items = self._parse_items(normalize(message))
+            items = llm_items if llm_items is not None else self._parse_items(normalize(message))
             if "vider" in normalize(message) or not items:
                 if context.get("current_order"):
                     context["current_order"] = []
@@ -485,32 +1224,38 @@ class ConversationService:
         elif intent == "confirm":
             cart = context.get("current_order", [])
             if cart:
-                order = self.order_service.create_order(phone, cart)
                 total = sum(i["price"] * i["quantity"] for i in cart)
                 lines = "\n".join(format_lines(cart))
-                admin_msg = (f"🍽️ *Nouvelle commande* #{order.id}\n"
+                context["state"] = "order_pending_restaurant"
+                context["current_order"] = []
+                # client + commande + contexte en une seule transaction
+                order_id = self.order_service.place_order(phone, cart, context)
+                context_saved = True
+                admin_msg = (f"🍽️ *Nouvelle commande* #{order_id}\n"
                              f"De: {phone}\n\n{lines}\n\n"
                              f"💰 Total: €{total:.2f}\n\n"
-                             f"Répondez: *ok {order.id}* / *preparer {order.id}* / "
-                             f"*pret {order.id}* / *livre {order.id}* / *annule {order.id}*")
+                             f"Répondez: *ok {order_id}* / *preparer {order_id}* / "
+                             f"*pret {order_id}* / *livre {order_id}* / *annule {order_id}*")
 
                 # Envoi au restaurant + fallback template (fenêtre 24h)
-                sent = self.whatsapp.send_message(config.RESTAURANT_PHONE, admin_msg)
+                sent = self.whatsapp.send_message(config.RESTAURANT_PHONE, admin_msg,
+                                                  kind="restaurant_order", order_id=order_id)
                 if not sent:
                     # Ouvre la fenêtre 24h avec un template simple puis envoie un court rappel
-                    self.whatsapp.send_template(config.RESTAURANT_PHONE, "hello_world", "en_US")
+                    self.whatsapp.send_template(config.RESTAURANT_PHONE, "hello_world", "en_US",
+                                                kind="restaurant_template", order_id=order_id)
                     self.whatsapp.send_message(
                         config.RESTAURANT_PHONE,
-                        f"Nouvelle commande #{order.id} (total €{total:.2f}). "
-                        f"Commandes: ok/preparer/pret/livre/annule {order.id}"
+                        f"Nouvelle commande #{order_id} (total €{total:.2f}). "
+                        f"Commandes: ok/preparer/pret/livre/annule {order_id}",
+                        kind="restaurant_order", order_id=order_id
                     )
 
                 # Réponse au client
-                response = (f"🎉 Commande #{order.id} envoyée au restaurant.\n"
+                response = (f"🎉 Commande #{order_id} envoyée au restaurant.\n"
                             "👨‍🍳 Vous recevrez une notification dès que c'est confirmé.")
-                context["state"] = "order_pending_restaurant"
-                context["current_order"] = []
-                context["last_order_id"] = order.id
+                self.reply_kind = "client_order_ack"
+                self.reply_order_id = order_id
             else:
                 response = "Votre panier est vide. Ajoutez des articles avant de confirmer !"
 
@@ -518,7 +1263,8 @@ class ConversationService:
             response = ("Je n'ai pas compris. Tapez *menu* pour voir nos options, "
                         "ou envoyez une commande du type *2 margherita et 1 coca*.")
 
-        self.update_conversation_context(phone, context)
+        if not context_saved:
+            self.update_conversation_context(phone, context)
         return response
 
     # ---- interactive replies (list)
@@ -571,9 +1317,8 @@ def process_admin_command(db: Session, text: str, whatsapp: WhatsAppService) ->
     if not order:
         return f"❌ Commande #{oid} introuvable."
 
-    # récup client
-    customer = db.query(Customer).filter(Customer.id == order.customer_id).first()
-    client_phone = customer.phone_number if customer else None
+    # récup client (cache téléphone <-> customer_id)
+    client_phone = svc.customer_phone(order.customer_id)
 
     # map status
     if cmd in ("ok", "confirmer"):
@@ -598,7 +1343,7 @@ def process_admin_command(db: Session, text: str, whatsapp: WhatsAppService) ->
 
     # notifie le client si possible
     if client_phone:
-        whatsapp.send_message(client_phone, client_msg)
+        whatsapp.send_message(client_phone, client_msg, kind=f"client_{new_status}", order_id=oid)
 
     return f"✅ Statut commande #{oid} → {new_status}"
 
@@ -615,6 +1360,14 @@ def _seed_on_startup():
     except Exception as e:
         logging.error(f"Init sample data failed: {e}", exc_info=True)
 
+@app.on_event("startup")
+def _start_delivery_flush():
+    delivery_tracker.start()
+
+@app.on_event("shutdown")
+def _flush_on_shutdown():
+    delivery_tracker.stop()
+
 @app.get("/")
 async def root():
     return {"message": "WhatsApp AI Agent actif!", "status": "running"}
@@ -627,68 +1380,83 @@ async def verify_webhook(request: Request):
         return int(challenge)
     raise HTTPException(status_code=403, detail="Token invalide")
 
+def process_webhook_body(db: Session, body: Dict) -> str:
+    """
+    Traitement synchrone d'un payload webhook (DB, Graph, LLM : appels bloquants).
+    Exécuté hors de la boucle asyncio. Retourne le statut renvoyé à Meta.
+    """
+    entries = body.get("entry", [])
+    if not entries:
+        return "ignored"
+
+    wa = WhatsAppService()
+    processed = False
+
+    for entry in entries:
+        for change in entry.get("changes", []):
+            value = change.get("value", {})
+            messages = value.get("messages", [])
+            statuses = value.get("statuses", [])
+
+            if statuses:
+                logging.debug(f"WA STATUS: {json.dumps(statuses)[:800]}")
+                delivery_tracker.record_statuses(statuses)
+
+            for msg in messages:
+                from_number = msg.get("from")
+                mtype = msg.get("type")
+
+                # Si c'est le numéro du restaurant, traiter comme commande admin
+                if from_number == config.RESTAURANT_PHONE and mtype == "text":
+                    text = (msg.get("text") or {}).get("body", "") or ""
+                    ack = process_admin_command(db, text, wa)
+                    if ack:
+                        wa.send_message(config.RESTAURANT_PHONE, ack, kind="admin_ack")
+                        processed = True
+                    continue
+
+                # Sinon, flux client normal
+                conv = ConversationService(db)
+
+                if mtype == "text":
+                    text = (msg.get("text") or {}).get("body", "") or ""
+                    if text.strip():
+                        reply = conv.process_incoming_message(from_number, text.strip())
+                        wa.send_message(from_number, reply, kind=conv.reply_kind,
+                                        order_id=conv.reply_order_id)
+                        processed = True
+
+                elif mtype == "interactive":
+                    interactive = msg.get("interactive", {})
+                    if "list_reply" in interactive:
+                        lr = interactive["list_reply"]
+                        lr_id = lr.get("id", "")
+                        title = lr.get("title", "")
+                        reply = conv.process_interactive_reply(from_number, lr_id, title)
+                        wa.send_message(from_number, reply)
+                        processed = True
+
+    return "success" if processed else "ok-empty"
+
 @app.post("/webhook")
 async def handle_webhook(request: Request, db: Session = Depends(get_db)):
     try:
         body = await request.json()
         logging.info(f"INCOMING: {json.dumps(body)[:1200]}")
-
-        entries = body.get("entry", [])
-        if not entries:
-            return JSONResponse({"status": "ignored"})
-
-        wa = WhatsAppService()
-        processed = False
-
-        for entry in entries:
-            for change in entry.get("changes", []):
-                value = change.get("value", {})
-                messages = value.get("messages", [])
-                statuses = value.get("statuses", [])
-
-                if statuses and not messages:
-                    logging.debug(f"WA STATUS ONLY: {json.dumps(statuses)[:800]}")
-                    continue
-
-                for msg in messages:
-                    from_number = msg.get("from")
-                    mtype = msg.get("type")
-
-                    # Si c'est le numéro du restaurant, traiter comme commande admin
-                    if from_number == config.RESTAURANT_PHONE and mtype == "text":
-                        text = (msg.get("text") or {}).get("body", "") or ""
-                        ack = process_admin_command(db, text, wa)
-                        if ack:
-                            wa.send_message(config.RESTAURANT_PHONE, ack)
-                            processed = True
-                        continue
-
-                    # Sinon, flux client normal
-                    conv = ConversationService(db)
-
-                    if mtype == "text":
-                        text = (msg.get("text") or {}).get("body", "") or ""
-                        if text.strip():
-                            reply = conv.process_incoming_message(from_number, text.strip())
-                            wa.send_message(from_number, reply)
-                            processed = True
-
-                    elif mtype == "interactive":
-                        interactive = msg.get("interactive", {})
-                        if "list_reply" in interactive:
-                            lr = interactive["list_reply"]
-                            lr_id = lr.get("id", "")
-                            title = lr.get("title", "")
-                            reply = conv.process_interactive_reply(from_number, lr_id, title)
-                            wa.send_message(from_number, reply)
-                            processed = True
-
-        return JSONResponse({"status": "success" if processed else "ok-empty"})
+        # threadpool : un message en attente du LLM ne bloque pas les autres webhooks,
+        # et les messages simultanés peuvent partager un même batch
+        status = await run_in_threadpool(process_webhook_body, db, body)
+        return JSONResponse({"status": status})
 
     except Exception as e:
         logging.exception(f"Erreur webhook: {e}")
         return JSONResponse({"error": str(e)}, status_code=500)
 
+@app.get("/admin/metrics/delivery")
+def delivery_metrics(hours: float = 24.0, db: Session = Depends(get_db)):
+    """Latences envoi -> delivered/read (p50/p90/p99, secondes) par type de message."""
+    return delivery_tracker.latency_report(db, hours=hours)
+
 # -----------------------------------------------------------------------------
 # Init + run
 # -----------------------------------------------------------------------------
@@ -0,0 +1,65 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# main.py crée l'engine à l'import : base SQLite jetable, pas de LLM réel
+_DB = tempfile.NamedTemporaryFile(suffix=".db", delete=False)
+os.environ["DATABASE_URL"] = f"sqlite:///{_DB.name}"
+os.environ["LLM_PROVIDER"] = ""
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+class FakeGraphResponse:
+    status_code = 200
+    text = "{}"
+
+    def __init__(self, wamid):
+        self.wamid = wamid
+
+    def json(self):
+        return {"messages": [{"id": self.wamid}]}
+
+
+@pytest.fixture(autouse=True)
+def fresh_db():
+    main.Base.metadata.drop_all(bind=main.engine)
+    main.Base.metadata.create_all(bind=main.engine)
+    main.init_sample_data()
+    main.customer_cache.clear()
+    main.delivery_tracker.flush()
+    yield
+    main.delivery_tracker.flush()
+
+
+@pytest.fixture
+def db():
+    session = main.SessionLocal()
+    try:
+        yield session
+    finally:
+        session.close()
+
+
+@pytest.fixture
+def sent(monkeypatch):
+    """Intercepte les appels Graph ; chaque envoi reçoit un wamid séquentiel."""
+    calls = []
+
+    def fake_post(url, json=None, headers=None, timeout=None):
+        calls.append(json)
+        return FakeGraphResponse(f"wamid.{len(calls)}")
+
+    monkeypatch.setattr(main.requests, "post", fake_post)
+    return calls
+
+
+def pytest_sessionfinish(session, exitstatus):
+    main.engine.dispose()
+    try:
+        os.unlink(_DB.name)
+    except OSError:
+        pass
@@ -0,0 +1,147 @@
+import time
+from datetime import datetime, timedelta
+
+import main
+from main import DeliveryTracker, MessageStatus, OutboundMessage, percentile
+
+
+def _epoch(dt):
+    return str(int((dt - datetime(1970, 1, 1)).total_seconds()))
+
+
+def test_percentile_nearest_rank():
+    assert percentile([], 50) is None
+    assert percentile([7.0], 99) == 7.0
+    values = [5.0, 1.0, 4.0, 2.0, 3.0]
+    assert percentile(values, 50) == 3.0
+    assert percentile(values, 90) == 5.0
+    assert percentile([1.0, 2.0], 50) == 1.0
+
+
+def test_record_statuses_parsing(db):
+    tracker = DeliveryTracker(max_size=100)
+    tracker.record_statuses([
+        {"id": "wamid.a", "status": "delivered", "timestamp": "1700000000", "recipient_id": "331"},
+        {"id": "wamid.b", "status": "failed", "timestamp": "pas-un-nombre",
+         "errors": [{"code": 131047, "title": "Re-engagement message"}]},
+        {"status": "read", "timestamp": "1700000000"},  # sans id : ignoré
+    ])
+    assert tracker.pending() == 2
+    assert tracker.flush() == 2
+
+    rows = {r.wamid: r for r in db.query(MessageStatus).all()}
+    assert rows["wamid.a"].timestamp == datetime(2023, 11, 14, 22, 13, 20)
+    assert rows["wamid.a"].recipient == "331"
+    assert rows["wamid.a"].error is None
+    assert rows["wamid.b"].timestamp is None
+    assert "131047" in rows["wamid.b"].error
+
+
+def test_flush_on_size():
+    tracker = DeliveryTracker(max_size=3, flush_seconds=3600)
+    tracker.record_outbound("wamid.1", "331", "reply")
+    tracker.record_outbound("wamid.2", "331", "reply")
+    assert tracker.pending() == 2
+    tracker.record_outbound("wamid.3", "331", "reply")
+    assert tracker.pending() == 0
+
+
+def test_background_timer_flushes_when_idle(db):
+    tracker = DeliveryTracker(max_size=100, flush_seconds=0.05)
+    tracker.start()
+    try:
+        tracker.record_outbound("wamid.idle", "331", "reply")
+        deadline = time.monotonic() + 2
+        while tracker.pending() and time.monotonic() < deadline:
+            time.sleep(0.02)
+        assert tracker.pending() == 0
+        assert db.query(OutboundMessage).filter(OutboundMessage.wamid == "wamid.idle").count() == 1
+    finally:
+        tracker.stop()
+
+
+def test_duplicate_wamid_does_not_drop_batch(db):
+    tracker = DeliveryTracker(max_size=100)
+    tracker.record_outbound("wamid.dup", "331", "reply")
+    tracker.flush()
+    tracker.record_outbound("wamid.dup", "331", "reply")
+    tracker.record_outbound("wamid.new", "331", "menu")
+    tracker.record_statuses([{"id": "wamid.new", "status": "sent", "timestamp": "1700000000"}])
+    tracker.flush()
+    assert db.query(OutboundMessage).count() == 2
+    assert db.query(MessageStatus).count() == 1
+    assert tracker.pending() == 0
+
+
+def test_failed_write_requeues_only_that_table(db, monkeypatch):
+    tracker = DeliveryTracker(max_size=100)
+    real_write = tracker._write
+
+    def failing_statuses(stmt, rows, label):
+        return False if label == "statuts" else real_write(stmt, rows, label)
+
+    monkeypatch.setattr(tracker, "_write", failing_statuses)
+    tracker.record_outbound("wamid.1", "331", "reply")
+    tracker.record_statuses([{"id": "wamid.1", "status": "sent", "timestamp": "1700000000"}])
+    assert tracker.flush() == 1
+    assert db.query(OutboundMessage).count() == 1
+    assert tracker.pending() == 1
+
+    monkeypatch.setattr(tracker, "_write", real_write)
+    assert tracker.flush() == 1
+    assert db.query(MessageStatus).count() == 1
+
+
+def test_requeue_is_capped(monkeypatch):
+    tracker = DeliveryTracker(max_size=100, max_pending=3)
+    monkeypatch.setattr(tracker, "_write", lambda stmt, rows, label: False)
+    tracker.record_statuses([{"id": f"wamid.{i}", "status": "sent", "timestamp": "1"} for i in range(5)])
+    tracker.flush()
+    assert tracker.pending() == 3
+
+
+def test_latency_report_per_kind(db):
+    tracker = DeliveryTracker(max_size=1000)
+    now = datetime.utcnow().replace(microsecond=0)
+    old = now - timedelta(hours=48)
+    db.add_all([
+        OutboundMessage(wamid="w1", phone_number="331", kind="restaurant_order", order_id=None, sent_at=now),
+        OutboundMessage(wamid="w2", phone_number="331", kind="restaurant_order", sent_at=now),
+        OutboundMessage(wamid="w3", phone_number="332", kind="client_confirmed", sent_at=now),
+        OutboundMessage(wamid="w-old", phone_number="333", kind="reply", sent_at=old),
+    ])
+    db.commit()
+    tracker.record_statuses([
+        {"id": "w1", "status": "delivered", "timestamp": _epoch(now + timedelta(seconds=2))},
+        # callback dupliqué : seul le premier compte
+        {"id": "w1", "status": "delivered", "timestamp": _epoch(now + timedelta(seconds=30))},
+        {"id": "w1", "status": "read", "timestamp": _epoch(now + timedelta(seconds=10))},
+        {"id": "w2", "status": "delivered", "timestamp": _epoch(now + timedelta(seconds=4))},
+        # horodatage illisible : ignoré dans les latences
+        {"id": "w2", "status": "read", "timestamp": "??"},
+        {"id": "w3", "status": "failed", "timestamp": _epoch(now)},
+        {"id": "w3", "status": "failed", "timestamp": _epoch(now)},
+        {"id": "w-old", "status": "delivered", "timestamp": _epoch(old + timedelta(seconds=1))},
+    ])
+    tracker.flush()
+
+    report = tracker.latency_report(db, hours=24)
+    assert set(report) == {"restaurant_order", "client_confirmed"}
+    resto = report["restaurant_order"]
+    assert resto["failed"] == 0
+    assert resto["delivered"] == {"count": 2, "p50": 2.0, "p90": 4.0, "p99": 4.0}
+    assert resto["read"]["count"] == 1 and resto["read"]["p50"] == 10.0
+    assert report["client_confirmed"]["failed"] == 1
+    assert report["client_confirmed"]["delivered"]["count"] == 0
+
+    assert "reply" in tracker.latency_report(db, hours=72)
+
+
+def test_webhook_ingests_statuses(sent):
+    from fastapi.testclient import TestClient
+
+    client = TestClient(main.app)
+    payload = {"entry": [{"changes": [{"value": {"statuses": [
+        {"id": "wamid.x", "status": "read", "timestamp": "1700000000"}]}}]}]}
+    assert client.post("/webhook", json=payload).status_code == 200
+    assert main.delivery_tracker.pending() == 1
@@ -0,0 +1,293 @@
+import threading
+import time
+
+import pytest
+
+import main
+from main import (ConversationService, LLMInterpreter, LLMProvider, StubLLMProvider, TTLCache,
+                  Order, sanitize_llm_result)
+
+CATALOG = ["Pizza Margherita", "Pizza Pepperoni", "Coca-Cola"]
+CANNED = "Je n'ai pas compris"
+
+
+class FakeProvider(LLMProvider):
+    """Enregistre les lots reçus ; délai et échec configurables."""
+
+    def __init__(self, delay=0.0, fail=False):
+        super().__init__()
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+
+    def interpret_batch(self, texts, catalog):
+        with self._lock:
+            self.batches.append(list(texts))
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            time.sleep(self.delay)
+            if self.fail:
+                raise RuntimeError("provider down")
+            return [{"intent": "order", "items": [{"name": "pizza margherita", "quantity": 2}]}
+                    for _ in texts]
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+def run_concurrently(fn, args_list):
+    results = [None] * len(args_list)
+
+    def worker(i, args):
+        results[i] = fn(*args)
+
+    threads = [threading.Thread(target=worker, args=(i, a)) for i, a in enumerate(args_list)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+
+# ---- cache
+def test_ttl_cache_expires():
+    cache = TTLCache(max_size=10, ttl=0.05)
+    cache.set("a", {"intent": "menu"})
+    assert cache.get("a") == {"intent": "menu"}
+    time.sleep(0.08)
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(max_size=2, ttl=60)
+    cache.set("a", {})
+    cache.set("b", {})
+    cache.get("a")
+    cache.set("c", {})
+    assert cache.get("b") is None
+    assert cache.get("a") == {} and cache.get("c") == {}
+
+
+def test_repeated_phrasing_hits_cache():
+    provider = FakeProvider()
+    llm = LLMInterpreter(provider, timeout=1, batch_window=0)
+    first = llm.interpret("Deux Margherita, svp !", CATALOG)
+    again = llm.interpret("deux   margherita svp", CATALOG)
+    assert first == again
+    assert len(provider.batches) == 1
+
+
+# ---- sanitize
+def test_sanitize_keeps_only_catalog_items():
+    result = sanitize_llm_result({"intent": "order", "items": [
+        {"name": "pizza margherita", "quantity": 99},
+        {"name": "Sushi", "quantity": 1},
+        {"name": "Coca-Cola", "quantity": "abc"},
+        "pas un dict",
+    ]}, CATALOG)
+    assert result == {"intent": "order", "items": [
+        {"name": "Pizza Margherita", "quantity": 20},
+        {"name": "Coca-Cola", "quantity": 1},
+    ]}
+
+
+def test_sanitize_never_returns_confirm():
+    assert sanitize_llm_result({"intent": "confirm", "items": []}, CATALOG)["intent"] == "other"
+    assert sanitize_llm_result(None, CATALOG) == {"intent": "other", "items": []}
+
+
+# ---- batching / concurrence / timeout
+def test_inflight_requests_are_deduplicated():
+    provider = FakeProvider(delay=0.1)
+    llm = LLMInterpreter(provider, timeout=2, batch_window=0.02)
+    results = run_concurrently(llm.interpret, [("2 margarita", CATALOG)] * 5)
+    assert all(r == results[0] for r in results)
+    assert provider.batches == [["2 margarita"]]
+
+
+def test_batch_size_limit():
+    provider = FakeProvider(delay=0.05)
+    llm = LLMInterpreter(provider, timeout=2, batch_size=4, batch_window=0.2, max_concurrency=4)
+    run_concurrently(llm.interpret, [(f"message {i}", CATALOG) for i in range(10)])
+    sizes = [len(b) for b in provider.batches]
+    assert sum(sizes) == 10
+    assert max(sizes) <= 4
+
+
+def test_batch_window_groups_close_messages_only():
+    provider = FakeProvider()
+    llm = LLMInterpreter(provider, timeout=2, batch_size=8, batch_window=0.3)
+    run_concurrently(llm.interpret, [(f"groupe {i}", CATALOG) for i in range(3)])
+    assert len(provider.batches) == 1 and len(provider.batches[0]) == 3
+
+    provider = FakeProvider()
+    llm = LLMInterpreter(provider, timeout=2, batch_size=8, batch_window=0.01)
+    llm.interpret("seul 1", CATALOG)
+    llm.interpret("seul 2", CATALOG)
+    assert provider.batches == [["seul 1"], ["seul 2"]]
+
+
+def test_concurrency_limit():
+    provider = FakeProvider(delay=0.1)
+    llm = LLMInterpreter(provider, timeout=5, batch_size=1, batch_window=0, max_concurrency=2)
+    run_concurrently(llm.interpret, [(f"texte {i}", CATALOG) for i in range(6)])
+    assert len(provider.batches) == 6
+    assert provider.peak == 2
+
+
+def test_timeout_returns_none_quickly():
+    llm = LLMInterpreter(FakeProvider(delay=0.5), timeout=0.05, batch_window=0)
+    t0 = time.monotonic()
+    assert llm.interpret("trop lent", CATALOG) is None
+    assert time.monotonic() - t0 < 0.3
+
+
+def test_provider_error_is_not_cached():
+    provider = FakeProvider(fail=True)
+    llm = LLMInterpreter(provider, timeout=1, batch_window=0)
+    assert llm.interpret("panne", CATALOG) is None
+    assert llm.interpret("panne", CATALOG) is None
+    assert len(provider.batches) == 2
+
+
+def test_provider_is_abstract():
+    with pytest.raises(TypeError):
+        LLMProvider()
+
+
+# ---- stub
+def test_stub_extracts_catalog_items():
+    stub = StubLLMProvider()
+    [res] = stub.interpret_batch(["deux margaritas et 3 pepperonis"], CATALOG)
+    assert res == {"intent": "order", "items": [
+        {"name": "Pizza Margherita", "quantity": 2},
+        {"name": "Pizza Pepperoni", "quantity": 3},
+    ]}
+
+
+@pytest.mark.parametrize("text", ["je veux annuler ma commande", "go", "envoie la commande", "je valide"])
+def test_stub_never_confirms(text):
+    [res] = StubLLMProvider().interpret_batch([text], CATALOG)
+    assert res["intent"] != "confirm"
+
+
+def test_stub_ignores_negated_items():
+    [res] = StubLLMProvider().interpret_batch(["euh non pas de coca"], CATALOG)
+    assert res == {"intent": "other", "items": []}
+    [res] = StubLLMProvider().interpret_batch(["une margarita sans coca"], CATALOG)
+    assert res["items"] == [{"name": "Pizza Margherita", "quantity": 1}]
+
+
+# ---- intégration conversation / webhook
+def stub_llm():
+    return LLMInterpreter(StubLLMProvider(), timeout=1, batch_window=0)
+
+
+def test_fallback_adds_items(db, sent):
+    conv = ConversationService(db, llm=stub_llm())
+    reply = conv.process_incoming_message("331", "deux margaritas stp")
+    assert "2× Pizza Margherita" in reply
+
+
+def test_fallback_never_places_an_order(db, sent):
+    conv = ConversationService(db, llm=stub_llm())
+    conv.process_incoming_message("331", "2 margherita")
+    reply = conv.process_incoming_message("331", "je veux annuler ma commande")
+    assert CANNED in reply
+    assert db.query(Order).count() == 0
+    assert not any(c["to"] == main.config.RESTAURANT_PHONE for c in sent)
+
+
+class IntentProvider(LLMProvider):
+    def __init__(self, result, db=None):
+        super().__init__()
+        self.result = result
+        self.db = db
+        self.db_in_transaction = None
+
+    def interpret_batch(self, texts, catalog):
+        if self.db is not None:
+            self.db_in_transaction = self.db.in_transaction()
+        return [dict(self.result) for _ in texts]
+
+
+def test_fallback_never_clears_cart(db, sent):
+    llm = LLMInterpreter(IntentProvider({"intent": "clear", "items": []}), timeout=1, batch_window=0)
+    conv = ConversationService(db, llm=llm)
+    conv.process_incoming_message("331", "2 margherita")
+    reply = conv.process_incoming_message("331", "bof je sais pas trop finalement")
+    assert CANNED in reply
+    assert conv.get_conversation_context("331")["current_order"][0]["quantity"] == 2
+
+
+def test_fallback_releases_db_transaction_while_waiting(db, sent):
+    provider = IntentProvider({"intent": "other", "items": []}, db=db)
+    conv = ConversationService(db, llm=LLMInterpreter(provider, timeout=1, batch_window=0))
+    conv.process_incoming_message("331", "blabla")
+    assert provider.db_in_transaction is False
+
+
+def test_fallback_timeout_gives_canned_reply(db, sent):
+    llm = LLMInterpreter(FakeProvider(delay=0.5), timeout=0.05, batch_window=0)
+    reply = ConversationService(db, llm=llm).process_incoming_message("331", "blabla")
+    assert CANNED in reply
+
+
+def test_concurrent_webhooks_share_a_batch(sent, monkeypatch):
+    from fastapi.testclient import TestClient
+
+    provider = FakeProvider(delay=0.05)
+    monkeypatch.setattr(main, "llm_interpreter",
+                        LLMInterpreter(provider, timeout=2, batch_size=8, batch_window=0.3))
+
+    def payload(frm, text):
+        return {"entry": [{"changes": [{"value": {"messages": [
+            {"from": frm, "type": "text", "text": {"body": text}}]}}]}]}
+
+    with TestClient(main.app) as client:
+        statuses = run_concurrently(
+            lambda frm, text: client.post("/webhook", json=payload(frm, text)).json()["status"],
+            [(f"33{i}", f"bizarre {i}") for i in range(3)])
+    assert statuses == ["success"] * 3
+    assert len(provider.batches) == 1 and len(provider.batches[0]) == 3
+
+
+def test_abandoned_requests_are_not_sent_to_provider():
+    provider = FakeProvider(delay=0.3)
+    llm = LLMInterpreter(provider, timeout=0.1, batch_size=1, batch_window=0, max_concurrency=1)
+    results = run_concurrently(llm.interpret, [(f"lent {i}", CATALOG) for i in range(6)])
+    assert results == [None] * 6
+    time.sleep(0.5)  # laisse le batcher vider la file
+    assert len(provider.batches) == 1
+    assert llm._inflight == {}
+
+
+def test_full_queue_falls_back_immediately():
+    provider = FakeProvider(delay=0.5)
+    llm = LLMInterpreter(provider, timeout=1, batch_size=1, batch_window=0,
+                         max_concurrency=1, max_queue=1)
+    threads = []
+    for i in range(3):  # 1 en cours, 1 bloqué sur le slot, 1 en file
+        t = threading.Thread(target=llm.interpret, args=(f"attente {i}", CATALOG))
+        t.start()
+        threads.append(t)
+        time.sleep(0.05)
+    t0 = time.monotonic()
+    assert llm.interpret("de trop", CATALOG) is None
+    assert time.monotonic() - t0 < 0.1
+    for t in threads:
+        t.join()
+
+
+def test_catalog_change_invalidates_cache():
+    provider = FakeProvider()
+    llm = LLMInterpreter(provider, timeout=1, batch_window=0)
+    llm.interpret("une margarita", ["Coca-Cola"])
+    llm.interpret("une margarita", ["Coca-Cola"])
+    llm.interpret("une margarita", CATALOG)
+    assert len(provider.batches) == 2
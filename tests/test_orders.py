@@ -0,0 +1,140 @@
+import json
+
+import pytest
+from sqlalchemy import insert
+from sqlalchemy.exc import IntegrityError
+
+import main
+from main import (Conversation, Customer, CustomerCache, Order, OrderService, OrderStatus,
+                  process_admin_command)
+
+ITEMS = [{"name": "Pizza Margherita", "price": 12.0, "quantity": 2}]
+
+
+# ---- CustomerCache
+def test_customer_cache_evicts_lru_in_both_directions():
+    cache = CustomerCache(max_size=2)
+    cache.put("331", 1)
+    cache.put("332", 2)
+    assert cache.get_phone(1) == "331"  # 331 devient le plus récent
+    cache.put("333", 3)
+    assert cache.get_id("332") is None and cache.get_phone(2) is None
+    assert cache.get_id("331") == 1 and cache.get_id("333") == 3
+    assert len(cache) == 2
+
+
+def test_customer_cache_remap_keeps_reverse_index_coherent():
+    cache = CustomerCache(max_size=10)
+    cache.put("331", 1)
+    cache.put("331", 7)
+    assert cache.get_id("331") == 7
+    assert cache.get_phone(1) is None
+    assert cache.get_phone(7) == "331"
+
+    cache.put("339", 7)  # l'id 7 change de numéro
+    assert cache.get_id("331") is None
+    assert cache.get_phone(7) == "339"
+
+
+def test_customer_cache_discard():
+    cache = CustomerCache()
+    cache.put("331", 1)
+    cache.discard("331")
+    assert cache.get_id("331") is None and cache.get_phone(1) is None
+
+
+# ---- place_order
+def test_place_order_single_transaction(db):
+    cache = CustomerCache()
+    context = {"state": "order_pending_restaurant", "current_order": []}
+    order_id = OrderService(db, cache).place_order("331", ITEMS, context)
+
+    order = db.get(Order, order_id)
+    customer = db.query(Customer).filter(Customer.phone_number == "331").one()
+    assert order.customer_id == customer.id
+    assert order.total_amount == 24.0 and order.status == OrderStatus.PENDING
+    conv = db.query(Conversation).filter(Conversation.phone_number == "331").one()
+    assert json.loads(conv.context)["last_order_id"] == order_id
+    assert cache.get_id("331") == customer.id
+
+    # client existant : pas de doublon, même id
+    second = OrderService(db, CustomerCache()).place_order("331", ITEMS, dict(context))
+    assert db.get(Order, second).customer_id == customer.id
+    assert db.query(Customer).count() == 1
+
+
+def test_cache_filled_only_after_commit(db, monkeypatch):
+    cache = CustomerCache()
+    svc = OrderService(db, cache)
+    seen = {}
+    real_commit = db.commit
+
+    def commit():
+        seen["cached_before_commit"] = cache.get_id("331")
+        real_commit()
+
+    monkeypatch.setattr(db, "commit", commit)
+    svc.place_order("331", ITEMS, {})
+    assert seen["cached_before_commit"] is None
+    assert cache.get_id("331") is not None
+
+
+def test_place_order_rolls_back_and_discards_cache(db, monkeypatch):
+    cache = CustomerCache()
+    cache.put("331", 999)  # id périmé
+
+    def boom(*args, **kwargs):
+        raise RuntimeError("db down")
+
+    monkeypatch.setattr(main, "save_conversation_context", boom)
+    with pytest.raises(RuntimeError):
+        OrderService(db, cache).place_order("331", ITEMS, {})
+
+    assert cache.get_id("331") is None
+    assert db.query(Order).count() == 0
+
+    cache = CustomerCache()
+    with pytest.raises(RuntimeError):
+        OrderService(db, cache).place_order("332", ITEMS, {})
+    assert cache.get_id("332") is None
+    assert db.query(Customer).count() == 0
+
+
+def test_admin_command_uses_customer_cache(db, sent):
+    order_id = OrderService(db).place_order("331", ITEMS, {})
+    main.customer_cache.clear()
+
+    ack = process_admin_command(db, f"ok {order_id}", main.WhatsAppService())
+    assert ack.endswith(OrderStatus.CONFIRMED)
+    assert sent[-1]["to"] == "331"
+    assert main.customer_cache.get_phone(db.get(Order, order_id).customer_id) == "331"
+
+
+def test_sqlite_rejects_dangling_customer_id(db):
+    with pytest.raises(IntegrityError):
+        db.execute(insert(Order).values(customer_id=424242, total_amount=1.0, items="[]"))
+    db.rollback()
+
+
+def test_stale_cached_customer_id_is_retried(db, monkeypatch):
+    cache = CustomerCache()
+    OrderService(db, cache).place_order("331", ITEMS, {})
+    db.query(Order).delete()
+    db.query(Customer).delete()
+    db.commit()
+    assert cache.get_id("331") is not None  # id périmé
+
+    attempts = []
+    real = OrderService._place_order
+
+    def spy(self, *args):
+        attempts.append(self.cache.get_id("331"))
+        return real(self, *args)
+
+    monkeypatch.setattr(OrderService, "_place_order", spy)
+    order_id = OrderService(db, cache).place_order("331", ITEMS, {})
+
+    assert len(attempts) == 2 and attempts[1] is None  # 1er essai FK KO, cache invalidé
+    customer = db.query(Customer).filter(Customer.phone_number == "331").one()
+    assert db.get(Order, order_id).customer_id == customer.id
+    assert cache.get_id("331") == customer.id